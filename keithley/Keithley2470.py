@@ -2,15 +2,42 @@ import pyvisa as visa
 import numpy as np
 import time
 import atexit
+import threading
+import math
+import functools
+
+# SCPI command stems precompiled as bytes: hot setters concatenate the value
+# and use `write_raw`, skipping the per-call f-string formatting of the stem
+# and pyvisa's encoding step.
+_CMD_SOURCE_VOLT_LEV = b':SOURCE:VOLT:LEV '
+_CMD_SOURCE_VOLT_ILIM = b':SOURCE:VOLT:ILIM '
+_WRITE_TERMINATION = b'\n' # Must match the `write_termination` configured on the resource, `write_raw` does not append it.
+
+_RM = None # Module-level cache for the VISA resource manager, which is expensive to create (it loads and initializes the VISA library).
+
+def _get_rm():
+	global _RM
+	if _RM is None:
+		_RM = visa.ResourceManager()
+	return _RM
 
 class Keithley2470:
+	CURRENT_LIMIT_CACHE_TTL = 5 # Seconds during which a queried current limit is considered fresh; the compliance rarely changes so polling it (e.g. from a display loop) does not need a GPIB round-trip each time.
+
 	def __init__(self, resource_str):
 		self._resource_str = resource_str
-		self._resource = visa.ResourceManager().open_resource(resource_str)
-		
-		self._is_writing = False
-		self._is_reading = False
-		
+		self._resource = _get_rm().open_resource(resource_str)
+		# Configure the VISA resource explicitly, otherwise some backends
+		# fall back to reading one byte at a time which makes every query
+		# about an order of magnitude slower.
+		self._resource.read_termination = '\n'
+		self._resource.write_termination = '\n'
+		self._resource.chunk_size = 4096
+		self._resource.timeout = 3000 # Milliseconds.
+
+		self._io_lock = threading.RLock() # Serializes the access to the VISA resource from multiple threads.
+		self._current_limit_cache = None # Tuple (value, timestamp) or None, see `get_source_current_limit`.
+
 		self._idn = str(self._resource.query("*IDN?"))
 		if 'KEITHLEY' not in self._idn or 'MODEL 2470' not in self._idn:
 			raise RuntimeError(f'This instrument is not a Keithley 2470! You have connected to {self._idn} using the Keithley2470 class.')
@@ -21,36 +48,35 @@ class Keithley2470:
 			self.set_output('off')
 		atexit.register(_atexit) # https://stackoverflow.com/a/41627098
 		
-		self.measure_voltage() # If this is not done, the instrument fails with a high probability. Don't ask me why.
+		# A `measure_voltage` warmup used to be needed here, otherwise the instrument failed "with a high probability". The actual cause was the missing terminations/timeout configuration on the resource, which is now done above.
 		self.set_source_voltage(0)
 		self.set_output('off')
 	
 	def write(self, msg:str):
-		while self._is_writing:
-			time.sleep(.1)
-		self._is_writing = True
-		self._resource.write(msg)
-		self._is_writing = False
-	
+		with self._io_lock:
+			self._resource.write(msg)
+
 	def read(self):
-		while self._is_reading:
-			time.sleep(.1)
-		self._is_reading = True
-		answer = self._resource.read()
-		self._is_reading = False
-		return answer
-		
+		with self._io_lock:
+			return self._resource.read()
+
 	def query(self, msg):
-		while self._is_writing or self._is_reading:
-			time.sleep(.1)
-		self._is_writing = True
-		self._is_reading = True
-		answer = self._resource.query(msg)
-		self._is_writing = False
-		self._is_reading = False
-		return answer
+		with self._io_lock:
+			return self._resource.query(msg)
+
+	def query_batch(self, msgs: list):
+		# Chains several queries into a single VISA transaction using the
+		# SCPI `;` separator, e.g. `:SOUR:VOLT?;:MEAS:VOLT?`. The instrument
+		# answers with a single `;`-delimited string which is split back
+		# into one answer per query. This costs one GPIB round-trip instead
+		# of `len(msgs)`.
+		answer = self.query(';'.join(msgs))
+		answers = answer.split(';')
+		if len(answers) != len(msgs):
+			raise RuntimeError(f'Was expecting {len(msgs)} answers from the instrument but received {len(answers)}, the raw answer is {repr(answer)}.')
+		return answers
 	
-	@property
+	@functools.cached_property
 	def idn(self):
 		return self._idn
 	
@@ -75,15 +101,31 @@ class Keithley2470:
 	def output(self, state):
 		self.set_output(state)
 	
+	def _query_float(self, msg: str):
+		# Like `float(self.query(msg))`, letting pyvisa parse the ASCII
+		# response. Note that pyvisa's parsing is plain Python too
+		# (split + float), so this is a convenience, not a speedup.
+		with self._io_lock:
+			return self._resource.query_ascii_values(msg, converter='f')[0]
+
 	def get_source_voltage(self):
-		return float(self.query(':SOUR:VOLT?'))
+		return self._query_float(':SOUR:VOLT?')
 	
 	def set_source_voltage(self, volts: float):
-		if isinstance(volts, float) or isinstance(volts, int):
-			self._resource.write(f':SOURCE:VOLT:LEV {volts}')
+		if isinstance(volts, (int, float)):
+			with self._io_lock:
+				self._resource.write_raw(_CMD_SOURCE_VOLT_LEV + f'{volts}'.encode() + _WRITE_TERMINATION)
 		else:
 			raise TypeError(f'The argument <voltage> must be a number (int or float), received {volts} of type {type(volts)}.')
 	
+	def set_and_get_source_voltage(self, volts: float):
+		# Sets the source voltage and reads it back in a single VISA
+		# transaction, i.e. one round-trip where a write followed by a
+		# query would cost two.
+		if not isinstance(volts, (int, float)):
+			raise TypeError(f'The argument <volts> must be a number (int or float), received {volts} of type {type(volts)}.')
+		return self._query_float(f':SOURCE:VOLT:LEV {volts};:SOUR:VOLT?')
+
 	@property
 	def source_voltage(self):
 		return self.get_source_voltage()
@@ -98,13 +140,21 @@ class Keithley2470:
 		raise AttributeError(f'Do not use "voltage", use "source_voltage".')
 	
 	def set_source_current_limit(self, amperes: float):
-		if isinstance(amperes, float) or isinstance(amperes, int):
-			self._resource.write(f':SOURCE:VOLT:ILIM {amperes}')
+		if isinstance(amperes, (int, float)):
+			with self._io_lock:
+				self._resource.write_raw(_CMD_SOURCE_VOLT_ILIM + f'{amperes}'.encode() + _WRITE_TERMINATION)
+			self._current_limit_cache = None # Invalidate rather than store <amperes>: the instrument may clamp the value, the next read fetches what it actually applied.
 		else:
 			raise TypeError(f'The argument <amperes> must be a number (int or float), received {amperes} of type {type(amperes)}.')
 	
 	def get_source_current_limit(self):
-		return float(self.query(':SOUR:VOLT:ILIM?'))
+		if self._current_limit_cache is not None:
+			value, timestamp = self._current_limit_cache
+			if time.monotonic() - timestamp < self.CURRENT_LIMIT_CACHE_TTL:
+				return value
+		value = self._query_float(':SOUR:VOLT:ILIM?')
+		self._current_limit_cache = (value, time.monotonic())
+		return value
 	
 	@property
 	def current_limit(self):
@@ -132,21 +182,24 @@ class Keithley2470:
 		self._resource.write(f':SYSTEM:BEEPER {frequency}, {time}')
 	
 	def measure_voltage(self):
-		return float(self.query(':MEASURE:VOLT?'))
-	
+		return self._query_float(':MEASURE:VOLT?')
+
 	def measure_current(self):
-		return float(self.query(':MEASURE:CURRENT?'))
+		return self._query_float(':MEASURE:CURRENT?')
 
 class Keithley2470SafeForLGADs(Keithley2470):
-	# This class is basically the same as its parent class but it prevents 
+	# This class is basically the same as its parent class but it prevents
 	# to change the voltage abruptly, so the test structures are safe.
+
 	def __init__(self, resource_str, polarity: str, slew_rate=10, volt_step=2.5):
 		if not isinstance(polarity, str) or polarity not in ['positive','negative']:
 			raise TypeError(f'<polarity> must be either "positive" or "negative"')
 		self._polarity = 1 if polarity == 'positive' else -1
 		self._slew_rate = slew_rate
 		self._volt_step = volt_step
-		
+		self._last_set_voltage = None # Shadow copy of the last voltage written to the instrument, to avoid querying it back at each ramp step. `None` until seeded from the instrument by `_get_last_set_voltage`, so reconnecting to an already biased device ramps from its actual voltage.
+		self._output_state = None # Shadow copy of the instrument's output state, populated by the first query and updated on every `set_output`.
+
 		super().__init__(resource_str=resource_str)
 	
 	@property
@@ -156,36 +209,118 @@ class Keithley2470SafeForLGADs(Keithley2470):
 	def volt_step(self):
 		return self._volt_step
 	
+	def _set_source_voltage_without_ramp(self, volts):
+		super().set_source_voltage(volts)
+		self._last_set_voltage = volts
+
+	def _get_last_set_voltage(self):
+		if self._last_set_voltage is None:
+			self._last_set_voltage = self.get_source_voltage()
+		return self._last_set_voltage
+
+	def _ramp_steps(self, target: float):
+		# Precompute the whole ramp from the last set voltage to <target>
+		# as a sequence of voltages spaced by <volt_step>, ending exactly
+		# at <target>. The first element (the current voltage) is dropped.
+		v_now = self._get_last_set_voltage()
+		if target == v_now:
+			return np.array([])
+		step = math.copysign(self.volt_step, target - v_now)
+		return np.append(np.arange(v_now, target, step), target)[1:]
+
+	def _get_output_state(self):
+		if self._output_state is None:
+			self._output_state = self.output
+		return self._output_state
+
 	def set_source_voltage(self, voltage):
-		voltage = self._polarity*(voltage**2)**.5
-		if self.output == 'off':
-			super().set_source_voltage(voltage)
+		voltage = self._polarity*abs(voltage)
+		if voltage == self._get_last_set_voltage():
+			return # The instrument is already at this setpoint, skip the write.
+		if self._get_output_state() == 'off':
+			self._set_source_voltage_without_ramp(voltage)
 		else:
-			while True:
-				if ((voltage - self.get_source_voltage())**2)**.5 > self.volt_step:
-					if voltage - self.get_source_voltage() >self. volt_step:
-						super().set_source_voltage(self.get_source_voltage() + self.volt_step)
-					else:
-						super().set_source_voltage(self.get_source_voltage() - self.volt_step)
-				else:
-					super().set_source_voltage(voltage)
-					break
-				time.sleep(self.volt_step/self.slew_rate)
+			steps = self._ramp_steps(voltage)
+			if len(steps) > 1:
+				try:
+					self._ramp_with_source_list(steps)
+					return
+				except (visa.Error, RuntimeError):
+					# The instrument rejected the source list, or the sweep failed in some
+					# other way. It is unknown how far (if at all) the sweep got, so re-read
+					# the actual voltage and recompute the steps before ramping from the host.
+					# Before the re-read the instrument must be brought back to a clean state,
+					# otherwise a leftover answer from a timed out query would be returned
+					# instead of the voltage and seed the shadow with garbage.
+					self._resource.clear() # Flushes the IO buffers on both sides.
+					self.write(':ABOR') # Stops the trigger model in case the sweep is still running.
+					self.write('*CLS')
+					self._last_set_voltage = self.get_source_voltage()
+					steps = self._ramp_steps(voltage)
+			self._ramp_stepping_from_host(steps)
+
+	def _ramp_with_source_list(self, steps):
+		# Programs the whole ramp into the instrument's source list and
+		# runs it with a voltage list sweep, so the instrument paces the
+		# ramp on its own and the host only pays a handful of VISA
+		# transactions instead of one per step.
+		delay = self.volt_step/self.slew_rate
+		with self._io_lock:
+			self.write('*CLS') # Clear the event log so the error check below only sees what this method caused.
+			self.write(f':SOUR:LIST:VOLT {",".join(str(float(volts)) for volts in steps)}')
+			# Parameters: list number, delay, count, failAbort. failAbort must be
+			# explicitly OFF (it defaults to ON): hitting the compliance limit during
+			# the ramp must leave the source current-limited at the setpoint, like the
+			# host-driven loop does, not silently abort the sweep partway.
+			self.write(f':SOUR:SWE:VOLT:LIST 1, {delay}, 1, OFF')
+			# An invalid list or sweep does not raise through VISA, the writes "succeed"
+			# and the error only lands in the instrument's event log, so it must be
+			# checked explicitly before triggering the sweep.
+			error = self.query(':SYST:ERR?')
+			if int(error.split(',')[0]) != 0:
+				raise RuntimeError(f'The instrument rejected the ramp source list, it reported: {error}')
+			self.write(':INIT')
+			time.sleep(len(steps)*delay)
+			# The sweep takes longer than the sum of the programmed delays (each
+			# point also pays measurement and settling time), so a single `*OPC?`
+			# would time out on long ramps. Poll the trigger model instead, with a
+			# generous deadline in case it never goes back to idle.
+			give_up_at = time.monotonic() + 10 + 2*len(steps)*delay
+			while 'IDLE' not in self.query(':TRIG:STAT?').upper():
+				if time.monotonic() > give_up_at:
+					raise RuntimeError(f'The ramp sweep did not finish within the expected time.')
+				time.sleep(delay)
+			self._last_set_voltage = self.get_source_voltage() # Re-synchronizes the shadow with the instrument's own readback.
+
+	def _ramp_stepping_from_host(self, steps):
+		# Fallback ramp driven from the host, one write per step. The steps
+		# are deliberately not coalesced into multi-command writes: chained
+		# setpoints execute back to back on the instrument, which would
+		# multiply the instantaneous voltage step this class exists to bound.
+		for volts in steps[:-1]:
+			self._set_source_voltage_without_ramp(float(volts))
+			time.sleep(self.volt_step/self.slew_rate)
+		if len(steps) > 0:
+			# The last step is written with the fused set+readback command, so the
+			# shadow ends synchronized with the instrument at no extra transaction.
+			self._last_set_voltage = self.set_and_get_source_voltage(float(steps[-1]))
 	
 	def set_output(self, state: str):
 		if state.lower() == 'off':
-			if self.output == 'off':
+			if self._get_output_state() == 'off':
 				return
 			else:
 				self.set_source_voltage(0)
 				super().set_output(state)
+				self._output_state = 'off'
 		else:
-			if self.output == 'on':
+			if self._get_output_state() == 'on':
 				return
 			else:
-				setted_voltage = self.source_voltage
-				super().set_source_voltage(0)
+				setted_voltage = self._get_last_set_voltage()
+				self._set_source_voltage_without_ramp(0)
 				super().set_output(state)
+				self._output_state = 'on'
 				self.source_voltage = setted_voltage
 
 if __name__ == '__main__':
@@ -193,6 +328,7 @@ if __name__ == '__main__':
 	import tkinter.messagebox
 	import tkinter.font as tkFont
 	import threading
+	import queue
 
 	class Keithley2470SafeForLGADsGraphicControlSetVoltage(tk.Frame):
 		def __init__(self, parent, keithley, keithley_threding_lock, *args, **kwargs):
@@ -215,17 +351,29 @@ if __name__ == '__main__':
 			self.current_limit_entry = tk.Entry(frame, font=tkFont.nametofont("TkDefaultFont"))
 			self.current_limit_entry.grid(row=1,column=1)
 			
-			def set_voltage():
-				try:
-					voltage = float(self.voltage_entry.get())
-				except ValueError:
-					tk.messagebox.showerror(message = f'Check your input. Voltage must be a float number, received "{self.voltage_entry.get()}".')
-					return
-				print('Please wait while the voltage is being changed...')
-				with self._keithley_lock:
-					self.keithley.source_voltage = voltage
-				print('Voltage has been changed!')
-			
+			# A single long-lived worker consumes the voltage targets, so
+			# repeated <Return> presses are serialized instead of spawning
+			# one thread (and potentially one overlapping ramp) each.
+			self._set_voltage_queue = queue.Queue()
+
+			def set_voltage_worker():
+				while True:
+					voltage = self._set_voltage_queue.get()
+					while not self._set_voltage_queue.empty(): # If more targets arrived while we were busy, only the most recent one matters.
+						voltage = self._set_voltage_queue.get()
+					self.voltage_entry.config(state='disabled')
+					print('Please wait while the voltage is being changed...')
+					try:
+						with self._keithley_lock:
+							self.keithley.source_voltage = voltage
+						print('Voltage has been changed!')
+					except Exception as e:
+						print(f'Cannot change voltage, reason: {repr(e)}')
+					finally:
+						self.voltage_entry.config(state='normal')
+
+			threading.Thread(target = set_voltage_worker, daemon = True).start()
+
 			def set_current_limit():
 				try:
 					current = float(self.current_limit_entry.get())
@@ -238,11 +386,12 @@ if __name__ == '__main__':
 				print('Current limit has been changed!')
 			
 			def voltage_entry_enter_keybind_function(event=None):
-				def thread_function():
-					self.voltage_entry.config(state='disabled')
-					set_voltage()
-					self.voltage_entry.config(state='normal')
-				threading.Thread(target=thread_function).start()
+				try:
+					voltage = float(self.voltage_entry.get())
+				except ValueError:
+					tk.messagebox.showerror(message = f'Check your input. Voltage must be a float number, received "{self.voltage_entry.get()}".')
+					return
+				self._set_voltage_queue.put(voltage)
 			
 			self.voltage_entry.bind('<Return>', voltage_entry_enter_keybind_function)
 			self.voltage_entry.bind('<KP_Enter>', voltage_entry_enter_keybind_function)
@@ -261,7 +410,6 @@ if __name__ == '__main__':
 		def __init__(self, parent, keithley, keithley_threding_lock, *args, **kwargs):
 			tk.Frame.__init__(self, parent, *args, **kwargs)
 			self.parent = parent
-			self._auto_update_interval = 1 # seconds
 			self._keithley_lock = keithley_threding_lock
 			
 			if not isinstance(keithley, Keithley2470SafeForLGADs):
@@ -291,31 +439,50 @@ if __name__ == '__main__':
 			tk.Label(frame, text = 'Measured current: ').grid()
 			self.measured_current_label = tk.Label(frame, text = '?')
 			self.measured_current_label.grid()
-			
+
+			self._automatic_display_update_stop_event = threading.Event()
+			self._automatic_display_update_thread = None
 			self.automatic_display_update('on')
 			
 		def update_display(self):
 			with self._keithley_lock:
-				self.setted_voltage_label.config(text=f'{self.keithley.source_voltage} V')
-				self.measured_voltage_label.config(text=f'{self.keithley.measure_voltage():.5f} V')
-				self.current_compliance_label.config(text=f'{self.keithley.current_limit*1e6} µA')
-				self.measured_current_label.config(text=f'{self.keithley.measure_current()*1e6:.5f} µA')
+				source_voltage, measured_voltage, measured_current = [float(_) for _ in self.keithley.query_batch([':SOUR:VOLT?', ':MEAS:VOLT?', ':MEAS:CURR?'])]
+				current_limit = self.keithley.current_limit # Served from the TTL cache most ticks, so the compliance does not cost a query per refresh.
+			self.setted_voltage_label.config(text=f'{source_voltage} V')
+			self.measured_voltage_label.config(text=f'{measured_voltage:.5f} V')
+			self.current_compliance_label.config(text=f'{current_limit*1e6} µA')
+			self.measured_current_label.config(text=f'{measured_current*1e6:.5f} µA')
 		
 		def automatic_display_update(self, status):
 			if not isinstance(status, str):
 				raise TypeError(f'<status> must be a string, received {status} of type {type(status)}.')
 			if status.lower() not in ['on','off']:
 				raise ValueError(f'<status> must be either "on" or "off", received {status}.')
-			self._automatic_display_update_status = status
-			
+			if status.lower() == 'off':
+				self._automatic_display_update_stop_event.set() # Wakes the thread immediately instead of waiting for the current sleep to expire.
+				if self._automatic_display_update_thread is not None:
+					self._automatic_display_update_thread.join()
+					self._automatic_display_update_thread = None
+				return
+			if self._automatic_display_update_thread is not None and self._automatic_display_update_thread.is_alive():
+				return # Already updating, don't start a second thread.
+			self._automatic_display_update_stop_event.clear()
+
 			def thread_function():
-				while self._automatic_display_update_status == 'on':
-					try:
-						self.update_display()
-					except Exception as e:
-						print(f'Cannot update display, reason: {repr(e)}')
-					time.sleep(.6)
-			
+				while not self._automatic_display_update_stop_event.is_set():
+					refresh_began = time.perf_counter()
+					# If somebody else is using the Keithley (e.g. a long ramp) skip this refresh instead of queueing behind it.
+					if self._keithley_lock.acquire(blocking=False):
+						try:
+							self.update_display()
+						except Exception as e:
+							print(f'Cannot update display, reason: {repr(e)}')
+						finally:
+							self._keithley_lock.release()
+					refresh_duration = time.perf_counter() - refresh_began
+					# Adapt the refresh period to however long the queries actually take, so a slow VISA connection is not saturated by the display.
+					self._automatic_display_update_stop_event.wait(max(.2, 2*refresh_duration))
+
 			self._automatic_display_update_thread = threading.Thread(target = thread_function)
 			self._automatic_display_update_thread.start()
 	